@@ -0,0 +1,74 @@
+"""Compare stories upgrade executors on the generated corpus.
+
+Run it with ``python benchmarks/executors.py`` in the environment where
+the package is installed with the ``stories`` extra.  Upgrades run inside
+the temporary corpus directory, so the patch is written relative to it
+even if the benchmark is started from the git repository.
+
+"""
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+import click
+
+from stories_upgrade import main
+
+STEP = """
+    def step{i}(self, ctx):
+        value = self.load(ctx.key{i})
+        return Success(
+            key{i}=value,
+            other{i}=[value, ctx.key{i}],
+        )
+"""
+
+
+def generate_corpus(directory, files, steps):
+    """Write story definitions into the directory."""
+    source = "class Action:\n" + "".join(STEP.format(i=i) for i in range(steps))
+    filenames = [f"module{i}.py" for i in range(files)]
+    for filename in filenames:
+        with open(os.path.join(directory, filename), "w") as f:
+            f.write(source)
+    return filenames
+
+
+@contextlib.contextmanager
+def working_directory(directory):
+    """Change the current directory for the duration of the block."""
+    previous = os.getcwd()
+    os.chdir(directory)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def measure(executor, filenames, patch):
+    """Run upgrade with the executor and return elapsed time."""
+    args = ["--executor", executor, "--patch-out", patch, *filenames]
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        main.main(args, standalone_mode=False)
+    return time.perf_counter() - started
+
+
+@click.command()
+@click.option("--files", default=2000, show_default=True)
+@click.option("--steps", default=5, show_default=True)
+@click.option("--repeat", default=3, show_default=True)
+def benchmark(files, steps, repeat):
+    """Print the best run time of each executor."""
+    with tempfile.TemporaryDirectory() as directory, working_directory(directory):
+        filenames = generate_corpus(directory, files, steps)
+        patch = "changes.patch"
+        for executor in ["serial", "thread", "process"]:
+            best = min(measure(executor, filenames, patch) for _ in range(repeat))
+            click.echo(f"{executor:>8}: {best:.3f}s, {files / best:.0f} files/s")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,85 @@
+"""Compare stories upgrade engines on returns with many keyword arguments.
+
+The rewrite of the single return is timed on already tokenized source to
+show the cost of the rewrite itself.  The whole engine including parsing
+is timed as well, since it is what users actually wait for.  Run it with
+``python benchmarks/wide_kwargs.py`` in the environment where the package
+is installed with the ``stories`` extra.
+
+"""
+import timeit
+from functools import partial
+
+import click
+from tokenize_rt import src_to_tokens
+
+from stories_upgrade import _find_closing_brace
+from stories_upgrade import _rewrite_return
+from stories_upgrade import _rewrite_return_batched
+from stories_upgrade import ENGINES
+
+
+REWRITES = {"batched": _rewrite_return_batched, "reference": _rewrite_return}
+
+
+def generate_source(width):
+    """Return story step with the given number of keyword arguments."""
+    kwargs = "".join(f"            key{i}=[ctx.value{i}, {i}],\n" for i in range(width))
+    return (
+        "class Action:\n"
+        "    def step(self, ctx):\n"
+        f"        return Success(\n{kwargs}        )\n"
+    )
+
+
+def locate(tokens):
+    """Return bounds of the return statement the engines rewrite."""
+    return_start = next(i for i, token in enumerate(tokens) if token.src == "return")
+    brace_start = next(
+        i for i in range(return_start, len(tokens)) if tokens[i].src == "("
+    )
+    return return_start, brace_start, _find_closing_brace(tokens, brace_start, "(")
+
+
+@click.command()
+@click.option("--width", "widths", multiple=True, default=[10, 100, 1000, 3000])
+@click.option("--repeat", default=5, show_default=True)
+def benchmark(widths, repeat):
+    """Print the best run time of each engine for every width."""
+    for width in widths:
+        source = generate_source(width)
+        tokens = src_to_tokens(source)
+        bounds = locate(tokens)
+        rewrite = {
+            name: measure(partial(rewrite_copy, func, tokens, bounds), repeat)
+            for name, func in REWRITES.items()
+        }
+        total = {
+            name: measure(partial(engine, source, None), repeat)
+            for name, engine in ENGINES.items()
+        }
+        click.echo(f"{width:>6} kwargs: rewrite {report(rewrite)}")
+        click.echo(f"{'':>6}         total {report(total)}")
+
+
+def rewrite_copy(func, tokens, bounds):
+    """Rewrite the copy of tokens, so every run starts from the same input."""
+    func(list(tokens), *bounds)
+
+
+def measure(func, repeat):
+    """Return the best run time of the function."""
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def report(timings):
+    """Format timings of both engines and the speedup of the batched one."""
+    speedup = timings["reference"] / timings["batched"]
+    return (
+        f"reference {timings['reference'] * 1000:.1f}ms, "
+        f"batched {timings['batched'] * 1000:.1f}ms ({speedup:.2f}x)"
+    )
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,173 @@
+"""Share parsed modules between code upgrade tools."""
+import ast
+import hashlib
+import os
+import pickle  # nosec
+import sys
+import tempfile
+from collections import OrderedDict
+from contextlib import suppress
+from importlib import metadata
+from threading import Lock
+from typing import cast
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from tokenize_rt import src_to_tokens
+from tokenize_rt import Token
+
+
+Parsed = Tuple[ast.Module, List[Token]]
+
+
+FORMAT_VERSION = 1
+
+
+TOKENIZE_RT_VERSION = metadata.version("tokenize-rt")
+
+
+class ParseCache:
+    """Parse results keyed by the source content and the parser versions.
+
+    Entries are kept serialized in memory for the lifetime of the cache
+    object and optionally persisted to the directory to survive between
+    runs.  The least recently used entries are evicted when the memory
+    or the disk limit is reached.  Both limits are measured in bytes of
+    the serialized entries, which is exactly what the cache holds.
+
+    The directory must be trusted: cached entries are loaded with
+    pickle, so anyone able to write there can run code in the process.
+
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        max_memory: int = 16 * 1024 * 1024,
+        max_disk: int = 256 * 1024 * 1024,
+    ) -> None:
+        self.directory = directory
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self.memory_size = 0
+        self.disk_size: Optional[int] = None
+        self.lock = Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def parse(self, source: str) -> Parsed:
+        """Return the module AST and tokens of the source text.
+
+        Every call returns a fresh copy, so callers are free to mutate
+        both the AST and the token list.
+
+        """
+        key = _key(source)
+        data = self._memory_get(key) or self._disk_get(key)
+        parsed = _loads(data) if data is not None else None
+        if parsed is None:
+            parsed = ast.parse(source), src_to_tokens(source)
+            data = _dumps(parsed)
+            self._disk_set(key, data)
+        self._memory_set(key, data)
+        return parsed
+
+    def _memory_get(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            if key not in self.memory:
+                return None
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+    def _memory_set(self, key: str, data: Optional[bytes]) -> None:
+        with self.lock:
+            if data is None or key in self.memory or len(data) > self.max_memory:
+                return
+            self.memory[key] = data
+            self.memory_size += len(data)
+            while self.memory_size > self.max_memory:
+                _key, evicted = self.memory.popitem(last=False)
+                self.memory_size -= len(evicted)
+
+    def _disk_get(self, key: str) -> Optional[bytes]:
+        if self.directory is None:
+            return None
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def _disk_set(self, key: str, data: Optional[bytes]) -> None:
+        if self.directory is None or data is None:
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(self.directory, key))
+        with self.lock:
+            if self.disk_size is None:
+                self.disk_size = _disk_usage(self.directory)
+            else:
+                self.disk_size += len(data)
+            if self.disk_size > self.max_disk:
+                self.disk_size = self._disk_evict()
+
+    def _disk_evict(self) -> int:
+        """Remove the oldest entries down to 90% of the disk limit.
+
+        Leaving the headroom lets the following writes skip the
+        directory scan, so eviction cost is amortized over many writes.
+
+        """
+        entries = sorted(_disk_entries(cast(str, self.directory)))
+        total = sum(size for _mtime, size, _path in entries)
+        for _mtime, size, path in entries:
+            if total <= self.max_disk * 0.9:
+                break
+            with suppress(FileNotFoundError):
+                os.remove(path)
+            total -= size
+        return total
+
+
+def _disk_usage(directory: str) -> int:
+    return sum(size for _mtime, size, _path in _disk_entries(directory))
+
+
+def _disk_entries(directory: str) -> Iterable[Tuple[float, int, str]]:
+    for entry in os.scandir(directory):
+        if not entry.name.endswith(".parsed"):
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        yield stat.st_mtime, stat.st_size, entry.path
+
+
+def _dumps(parsed: Parsed) -> Optional[bytes]:
+    try:
+        return pickle.dumps(parsed, pickle.HIGHEST_PROTOCOL)
+    except RecursionError:
+        return None
+
+
+def _loads(data: bytes) -> Optional[Parsed]:
+    try:
+        return cast(Parsed, pickle.loads(data))  # nosec
+    except (EOFError, pickle.UnpicklingError):
+        return None
+
+
+def _key(source: str) -> str:
+    digest = hashlib.sha256(source.encode()).hexdigest()
+    grammar = "{}.{}".format(*sys.version_info[:2])
+    tokenizer = f"tokenize-rt{TOKENIZE_RT_VERSION}"
+    return f"{digest}-py{grammar}-{tokenizer}-v{FORMAT_VERSION}.parsed"
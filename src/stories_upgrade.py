@@ -1,14 +1,40 @@
 """Upgrade classes with stories definitions to the new version of the library API."""
 import ast
+import ctypes
+import difflib
+import json
+import os
+import re
+import select
+import struct
+import subprocess  # nosec
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from contextlib import contextmanager
+from contextlib import suppress
+from dataclasses import asdict
 from dataclasses import dataclass
 from dataclasses import field
+from functools import partial
 from itertools import dropwhile
 from itertools import islice
 from itertools import takewhile
+from threading import Lock
+from tokenize import TokenError
+from typing import Callable
 from typing import cast
+from typing import Dict
 from typing import Iterable
+from typing import Iterator
 from typing import List
+from typing import Mapping
+from typing import NamedTuple
 from typing import Optional
+from typing import Protocol
 from typing import Set
 from typing import Tuple
 from typing import Union
@@ -21,6 +47,9 @@ from tokenize_rt import src_to_tokens
 from tokenize_rt import Token
 from tokenize_rt import tokens_to_src
 
+from parse_cache import Parsed
+from parse_cache import ParseCache
+
 
 @click.command()
 @click.argument(
@@ -30,32 +59,875 @@ from tokenize_rt import tokens_to_src
         exists=True, file_okay=True, dir_okay=False, readable=True, writable=True
     ),
 )
+@click.option(
+    "--cache-dir",
+    type=click.Path(file_okay=False, dir_okay=True, writable=True),
+    help="Trusted directory to keep parsed modules between runs.",
+)
+@click.option(
+    "--progress", is_flag=True, help="Show progress and throughput on stderr."
+)
+@click.option(
+    "--metrics-file",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Write final metrics in the Prometheus text format.",
+)
+@click.option(
+    "--patch-out",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Write all changes to the single patch file instead of updating files.",
+)
+@click.option(
+    "--git-tree",
+    metavar="TREE-ISH",
+    help="Upgrade Python files of the git tree and write the result as a new commit.",
+)
+@click.option(
+    "--git-message",
+    default="Upgrade stories",
+    show_default=True,
+    help="Message of the commit created by --git-tree.",
+)
+@click.option(
+    "--watch",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True),
+    help="Upgrade Python files in the directory as they change.",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(["batched", "reference"]),
+    default="batched",
+    show_default=True,
+    help="Implementation of the upgrade to use.",
+)
+@click.option(
+    "--differential",
+    is_flag=True,
+    help="Compare the engine output with the reference engine on every file.",
+)
+@click.option(
+    "--executor",
+    type=click.Choice(["serial", "thread", "process"]),
+    default="serial",
+    show_default=True,
+    help="Run files one by one, in the thread pool, or in the process pool.",
+)
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["text", "jsonl"]),
+    default="text",
+    show_default=True,
+    help="Report updated files as text or every rewritten return as JSON Lines.",
+)
 @click.pass_context
-def main(ctx: click.Context, filenames: List[str]) -> None:
+def main(
+    ctx: click.Context,
+    filenames: List[str],
+    cache_dir: Optional[str],
+    progress: bool,
+    metrics_file: Optional[str],
+    patch_out: Optional[str],
+    git_tree: Optional[str],
+    git_message: str,
+    watch: Optional[str],
+    engine: str,
+    differential: bool,
+    executor: str,
+    output_format: str,
+) -> None:
     """CLI entrypoint for stories upgrade tool."""
-    modified = 0
-    for filename in filenames:
-        with open(filename, "r") as f:
-            source = f.read()
-        output = _upgrade(source)
-        if source != output:
-            modified += 1
-            click.echo(f"Update {click.format_filename(f.name)}")
-            with open(filename, "w") as f:
-                f.write(output)
-    if modified:
-        suffix = "s" if modified > 1 else ""
-        click.echo(f"\n{modified} file{suffix} updated")
+    options = _EngineOptions(engine, differential, cache_dir, watch is not None)
+    upgrade = _select_engine(options)
+    metrics = _Metrics()
+    tracker = _Progress(filenames, metrics, enabled=progress)
+    out = _Output(jsonl=output_format == "jsonl", progress=tracker)
+    unsupported = {
+        "FILENAMES": bool(filenames),
+        "--patch-out": patch_out is not None,
+        "--progress": progress,
+        "--executor": executor != "serial",
+    }
+    if git_tree is not None:
+        _reject_options(unsupported, "--git-tree")
+        _upgrade_git_tree(upgrade, metrics, out, git_tree, git_message)
+    elif watch is not None:
+        _reject_options(unsupported, "--watch")
+        _upgrade_watch(upgrade, metrics, out, watch)
+    else:
+        results = EXECUTORS[executor](filenames, upgrade, options)
+        _upgrade_files(results, metrics, out, tracker, patch_out)
+    _write_metrics(metrics_file, metrics)
+    _report(ctx, upgrade, metrics, out)
+
+
+def _report(
+    ctx: click.Context, upgrade: "Upgrade", metrics: "_Metrics", out: "_Output"
+) -> None:
+    if isinstance(upgrade, _Differential):
+        out.info(upgrade.report())
+    if metrics.modified:
+        suffix = "s" if metrics.modified > 1 else ""
+        out.info(f"\n{metrics.modified} file{suffix} updated")
         ctx.exit(1)
 
 
-def _upgrade(source: str) -> str:
-    ast_obj = _ast_parse(source)
-    visitor = _FindAssignment()
-    visitor.visit(ast_obj)
-    tokens = src_to_tokens(source)
-    _mutate_found(tokens, visitor)
-    return tokens_to_src(tokens)
+def _reject_options(options: Dict[str, bool], mode: str) -> None:
+    for name, used in options.items():
+        if used:
+            raise click.UsageError(f"{name} can not be used together with {mode}")
+
+
+def _upgrade_files(
+    results: Iterable["_Result"],
+    metrics: "_Metrics",
+    out: "_Output",
+    tracker: "_Progress",
+    patch_out: Optional[str],
+) -> None:
+    with _open_writer(patch_out) as write:
+        for result in results:
+            out.report(result)
+            if result.changed:
+                write(result)
+            metrics.observe(result)
+            tracker.update()
+    tracker.finish()
+
+
+def _upgrade_git_tree(
+    upgrade: "Upgrade",
+    metrics: "_Metrics",
+    out: "_Output",
+    tree: str,
+    message: str,
+) -> None:
+    entries = _git_ls_tree(tree)
+    updates = []
+    for entry, blob in zip(entries, _git_cat_blobs(entries)):
+        result = _run_blob(upgrade, entry.path, blob)
+        out.report(result)
+        if result.changed:
+            updates.append((entry, result.output))
+        metrics.observe(result)
+    if updates:
+        out.info(f"Commit {_git_commit(tree, updates, message)}")
+
+
+def _upgrade_watch(
+    upgrade: "Upgrade", metrics: "_Metrics", out: "_Output", directory: str
+) -> None:
+    click.echo(f"Watching {click.format_filename(directory)}", err=True)
+    session = _WatchSession(upgrade, metrics, out)
+    with closing(_create_watcher(directory)) as watcher, suppress(KeyboardInterrupt):
+        for changed in watcher:
+            for filename in sorted(changed):
+                session.update(filename)
+
+
+@dataclass
+class _WatchSession:
+    upgrade: "Upgrade"
+    metrics: "_Metrics"
+    out: "_Output"
+    written: Dict[str, str] = field(default_factory=dict)
+
+    def update(self, filename: str) -> None:
+        if not os.path.isfile(filename):
+            return
+        try:
+            self.process(filename)
+        except (OSError, UnicodeDecodeError) as error:
+            skipped = f"can not update: {error}"
+            self.report(_Result(filename, "", "", 0.0, skipped=skipped))
+
+    def process(self, filename: str) -> None:
+        started = time.perf_counter()
+        with open(filename, "r", newline="") as f:
+            source = f.read()
+        if self.written.pop(filename, None) == source:
+            return
+        result = _run(self.upgrade, filename, source, started)
+        if result.changed:
+            _write_source(result)
+            self.written[filename] = result.output
+        self.report(result)
+
+    def report(self, result: "_Result") -> None:
+        self.out.report(result)
+        self.metrics.observe(result)
+
+
+@dataclass
+class _Edit:
+    line: int
+    column: int
+    returned: str
+    keywords: List[Optional[str]]
+    skipped: Optional[str] = None
+
+
+@dataclass
+class _Result:
+    filename: str
+    source: str
+    output: str
+    elapsed: float
+    edits: List[_Edit] = field(default_factory=list)
+    skipped: Optional[str] = None
+
+    @property
+    def changed(self) -> bool:
+        return self.source != self.output
+
+
+def _process(filename: str, upgrade: "Upgrade") -> _Result:
+    started = time.perf_counter()
+    with open(filename, "r", newline="") as f:
+        source = f.read()
+    return _run(upgrade, filename, source, started)
+
+
+def _run_blob(upgrade: "Upgrade", path: str, blob: bytes) -> _Result:
+    started = time.perf_counter()
+    try:
+        source = blob.decode()
+    except UnicodeDecodeError as error:
+        elapsed = time.perf_counter() - started
+        return _Result(path, "", "", elapsed, skipped=f"can not decode: {error}")
+    return _run(upgrade, path, source, started)
+
+
+def _run(upgrade: "Upgrade", filename: str, source: str, started: float) -> _Result:
+    try:
+        output, edits = upgrade(source)
+    except _EngineMismatch as error:
+        raise click.ClickException(f"{filename}: {error}")
+    except _Skipped as error:
+        elapsed = time.perf_counter() - started
+        return _Result(filename, source, source, elapsed, skipped=str(error))
+    return _Result(filename, source, output, time.perf_counter() - started, edits)
+
+
+@dataclass
+class _Output:
+    jsonl: bool = False
+    progress: Optional["_Progress"] = None
+
+    def report(self, result: _Result) -> None:
+        if self.jsonl:
+            self.report_jsonl(result)
+        else:
+            self.report_text(result)
+
+    def report_text(self, result: _Result) -> None:
+        filename = click.format_filename(result.filename)
+        if result.changed:
+            self.echo(f"Update {filename}")
+        if result.skipped:
+            self.echo(f"Skip {filename}: {result.skipped}", err=True)
+        for edit in result.edits:
+            if edit.skipped:
+                location = f"{filename}:{edit.line}:{edit.column}"
+                self.echo(f"Skip {location}: {edit.skipped}", err=True)
+
+    def report_jsonl(self, result: _Result) -> None:
+        if result.skipped:
+            fields = {**FILE_FIELDS, "skipped": result.skipped}
+            self.echo(_jsonl_record("file", result.filename, fields))
+        for edit in result.edits:
+            self.echo(_jsonl_record("return", result.filename, asdict(edit)))
+
+    def info(self, message: str) -> None:
+        self.echo(message, err=self.jsonl)
+
+    def echo(self, message: str, err: bool = False) -> None:
+        if self.progress is not None:
+            self.progress.clear()
+        click.echo(message, err=err)
+
+
+FILE_FIELDS = {"line": None, "column": None, "returned": None, "keywords": None}
+
+
+def _jsonl_record(kind: str, filename: str, fields: Mapping[str, object]) -> str:
+    return json.dumps({"kind": kind, "file": filename, **fields})
+
+
+class _EngineOptions(NamedTuple):
+    name: str
+    differential: bool
+    cache_dir: Optional[str]
+    keep_parsed: bool = False
+
+
+def _serial_map(
+    filenames: List[str], upgrade: "Upgrade", options: _EngineOptions
+) -> Iterator[_Result]:
+    for filename in filenames:
+        yield _process(filename, upgrade)
+
+
+def _thread_map(
+    filenames: List[str], upgrade: "Upgrade", options: _EngineOptions
+) -> Iterator[_Result]:
+    with ThreadPoolExecutor() as pool:
+        yield from pool.map(partial(_process, upgrade=upgrade), filenames)
+
+
+def _process_map(
+    filenames: List[str], upgrade: "Upgrade", options: _EngineOptions
+) -> Iterator[_Result]:
+    if options.differential:
+        raise click.UsageError("--differential can not be used with process executor")
+    with ProcessPoolExecutor(initializer=_init_worker, initargs=(options,)) as pool:
+        yield from pool.map(_process_in_worker, filenames, chunksize=8)
+
+
+EXECUTORS = {"serial": _serial_map, "thread": _thread_map, "process": _process_map}
+
+
+_worker_upgrade: Optional["Upgrade"] = None
+
+
+def _init_worker(options: _EngineOptions) -> None:
+    global _worker_upgrade
+    _worker_upgrade = _select_engine(options)
+
+
+def _process_in_worker(filename: str) -> _Result:
+    return _process(filename, cast("Upgrade", _worker_upgrade))
+
+
+Writer = Callable[[_Result], None]
+
+
+@contextmanager
+def _open_writer(patch_out: Optional[str]) -> Iterator[Writer]:
+    if patch_out is None:
+        yield _write_source
+        return
+    root = _patch_root()
+    with open(patch_out, "w", newline="") as f:
+
+        def write_patch(result: _Result) -> None:
+            f.writelines(_diff(result, root))
+            f.flush()
+
+        yield write_patch
+
+
+def _write_source(result: _Result) -> None:
+    with open(result.filename, "w", newline="") as f:
+        f.write(result.output)
+
+
+def _patch_root() -> str:
+    process = subprocess.run(  # nosec
+        ["git", "rev-parse", "--show-toplevel"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    if process.returncode:
+        return os.getcwd()
+    return os.fsdecode(process.stdout.rstrip(b"\n"))
+
+
+def _patch_path(filename: str, root: str) -> str:
+    path = os.path.relpath(os.path.realpath(filename), os.path.realpath(root))
+    if path == os.pardir or path.startswith(os.pardir + os.sep):
+        raise click.ClickException(f"{filename} is outside of {root}")
+    return path.replace(os.sep, "/")
+
+
+def _diff(result: _Result, root: str) -> Iterable[str]:
+    path = _patch_path(result.filename, root)
+    yield f"diff --git a/{path} b/{path}\n"
+    lines = difflib.unified_diff(
+        _split_lines(result.source),
+        _split_lines(result.output),
+        f"a/{path}",
+        f"b/{path}",
+    )
+    for line in lines:
+        yield line if line.endswith("\n") else f"{line}\n\\ No newline at end of file\n"
+
+
+def _split_lines(text: str) -> List[str]:
+    lines = LINE_END.split(text)
+    return lines if lines[-1] else lines[:-1]
+
+
+LINE_END = re.compile("(?<=\n)")
+
+
+class _GitEntry(NamedTuple):
+    mode: str
+    sha: str
+    path: str
+
+
+def _git(*args: str, stdin: bytes = b"", env: Optional[Dict[str, str]] = None) -> bytes:
+    process = subprocess.run(  # nosec
+        ["git", *args], input=stdin, stdout=subprocess.PIPE, env=env
+    )
+    if process.returncode:
+        raise click.ClickException(f"git {args[0]} failed")
+    return process.stdout
+
+
+def _git_ls_tree(tree: str) -> List[_GitEntry]:
+    entries = []
+    for line in _git("ls-tree", "-r", "-z", "--full-tree", tree).split(b"\0")[:-1]:
+        info, raw_path = line.split(b"\t", 1)
+        mode, kind, sha = info.decode().split()
+        path = os.fsdecode(raw_path)
+        if kind == "blob" and mode != "120000" and path.endswith(".py"):
+            entries.append(_GitEntry(mode, sha, path))
+    return entries
+
+
+def _git_cat_blobs(entries: List[_GitEntry]) -> Iterable[bytes]:
+    stdin = "".join(f"{entry.sha}\n" for entry in entries).encode()
+    stdout = _git("cat-file", "--batch", stdin=stdin)
+    offset = 0
+    for _entry in entries:
+        start = stdout.index(b"\n", offset) + 1
+        end = start + int(stdout[offset:start].split()[2])
+        yield stdout[start:end]
+        offset = end + 1
+
+
+def _git_hash_blobs(sources: List[str]) -> List[str]:
+    stream = b"".join(
+        b"blob\nmark :%d\ndata %d\n%s\n" % (mark, len(data), data)
+        for mark, data in enumerate((source.encode() for source in sources), 1)
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        marks = os.path.join(tmp, "marks")
+        _git("fast-import", "--quiet", f"--export-marks={marks}", stdin=stream)
+        with open(marks) as f:
+            shas = dict(line.split() for line in f)
+    return [shas[f":{mark}"] for mark in range(1, len(sources) + 1)]
+
+
+def _git_commit(tree: str, updates: List[Tuple[_GitEntry, str]], message: str) -> str:
+    shas = _git_hash_blobs([output for _entry, output in updates])
+    index_info = b"".join(
+        f"{entry.mode} {sha}\t".encode() + os.fsencode(entry.path) + b"\0"
+        for (entry, _output), sha in zip(updates, shas)
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {**os.environ, "GIT_INDEX_FILE": os.path.join(tmp, "index")}
+        _git("read-tree", tree, env=env)
+        _git("update-index", "-z", "--index-info", stdin=index_info, env=env)
+        new_tree = _git("write-tree", env=env).decode().strip()
+    options = [option for parent in _git_parents(tree) for option in ["-p", parent]]
+    commit = _git("commit-tree", new_tree, *options, "-m", message)
+    return commit.decode().strip()
+
+
+def _git_parents(tree: str) -> List[str]:
+    process = subprocess.run(  # nosec
+        ["git", "rev-parse", "-q", "--verify", f"{tree}^{{commit}}"],
+        stdout=subprocess.PIPE,
+    )
+    return process.stdout.decode().split()
+
+
+def _create_watcher(directory: str, debounce: float = 0.2) -> "_Watcher":
+    try:
+        return _InotifyWatcher(directory, debounce)
+    except OSError:
+        return _PollingWatcher(directory, debounce)
+
+
+class _Watcher(Protocol):
+    def __iter__(self) -> Iterator[Set[str]]:
+        ...  # pragma: no cover
+
+    def close(self) -> None:
+        ...  # pragma: no cover
+
+
+def _watched_directories(directory: str) -> Iterator[str]:
+    for root, dirs, _files in os.walk(directory):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        yield root
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+# New files are reported once closed after write, creation events are used
+# only to watch new directories.
+INOTIFY_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class _InotifyWatcher:
+    def __init__(self, directory: str, debounce: float) -> None:
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is available on Linux only")
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.debounce = debounce
+        self.directories: Dict[int, str] = {}
+        try:
+            for path in _watched_directories(directory):
+                self.add(path)
+        except OSError:
+            self.close()
+            raise
+
+    def add(self, path: str) -> None:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), INOTIFY_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self.directories[wd] = path
+
+    def add_new(self, path: str) -> None:
+        try:
+            for directory in _watched_directories(path):
+                self.add(directory)
+        except FileNotFoundError:
+            pass
+        except OSError as error:
+            filename = click.format_filename(path)
+            click.echo(f"Can not watch {filename}: {error.strerror}", err=True)
+
+    def __iter__(self) -> Iterator[Set[str]]:
+        while True:
+            changed: Set[str] = set()
+            select.select([self.fd], [], [])
+            while select.select([self.fd], [], [], self.debounce)[0]:
+                changed.update(self.read())
+            yield {path for path in changed if path.endswith(".py")}
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+    def read(self) -> Iterator[str]:
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            start = offset + INOTIFY_EVENT.size
+            offset = start + length
+            name = os.fsdecode(data[start:offset].rstrip(b"\0"))
+            path = self.event(wd, mask, name)
+            if path is not None:
+                yield path
+
+    def event(self, wd: int, mask: int, name: str) -> Optional[str]:
+        path = os.path.join(self.directories.get(wd, ""), name)
+        if mask & IN_ISDIR:
+            if not name.startswith("."):
+                self.add_new(path)
+            return None
+        if mask & IN_CREATE:
+            return None
+        return path
+
+
+class _PollingWatcher:
+    def __init__(self, directory: str, debounce: float) -> None:
+        self.directory = directory
+        self.debounce = debounce
+        self.snapshot = self.scan()
+
+    def scan(self) -> Dict[str, Tuple[int, int]]:
+        snapshot = {}
+        for root in _watched_directories(self.directory):
+            for entry in os.scandir(root):
+                if entry.name.endswith(".py") and entry.is_file():
+                    stat = entry.stat()
+                    snapshot[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def __iter__(self) -> Iterator[Set[str]]:
+        changed: Set[str] = set()
+        while True:
+            time.sleep(self.debounce)
+            more = self.poll()
+            if changed and not more:
+                yield changed
+            changed = changed | more if more else set()
+
+    def close(self) -> None:
+        pass
+
+    def poll(self) -> Set[str]:
+        snapshot = self.scan()
+        changed = {
+            path for path, stat in snapshot.items() if self.snapshot.get(path) != stat
+        }
+        self.snapshot = snapshot
+        return changed
+
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+@dataclass
+class _Metrics:
+    files: int = 0
+    modified: int = 0
+    skipped: int = 0
+    size: int = 0
+    started: float = field(default_factory=time.perf_counter)
+    latency_sum: float = 0.0
+    latency_buckets: List[int] = field(
+        default_factory=lambda: [0] * len(LATENCY_BUCKETS)
+    )
+
+    def observe(self, result: _Result) -> None:
+        self.files += 1
+        self.modified += result.changed
+        self.skipped += bool(result.skipped)
+        self.skipped += sum(bool(edit.skipped) for edit in result.edits)
+        self.size += len(result.source.encode())
+        self.latency_sum += result.elapsed
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            self.latency_buckets[i] += result.elapsed <= bound
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def render(self) -> str:
+        lines = [
+            *_metric("files_total", "counter", "Files processed.", self.files),
+            *_metric("modified_total", "counter", "Files updated.", self.modified),
+            *_metric(
+                "skipped_total", "counter", "Files and returns skipped.", self.skipped
+            ),
+            *_metric("bytes_total", "counter", "Source bytes processed.", self.size),
+            *_metric("duration_seconds", "gauge", "Total run time.", self.elapsed),
+            *_metric_header(
+                "file_duration_seconds", "histogram", "Time spent on single file."
+            ),
+        ]
+        name = "stories_upgrade_file_duration_seconds"
+        for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets):
+            lines.append(f'{name}_bucket{{le="{bound}"}} {count}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.files}')
+        lines.append(f"{name}_sum {self.latency_sum}")
+        lines.append(f"{name}_count {self.files}")
+        return "\n".join(lines) + "\n"
+
+
+def _metric(
+    name: str, kind: str, description: str, value: Union[int, float]
+) -> List[str]:
+    return [*_metric_header(name, kind, description), f"stories_upgrade_{name} {value}"]
+
+
+def _metric_header(name: str, kind: str, description: str) -> List[str]:
+    return [
+        f"# HELP stories_upgrade_{name} {description}",
+        f"# TYPE stories_upgrade_{name} {kind}",
+    ]
+
+
+def _write_metrics(metrics_file: Optional[str], metrics: _Metrics) -> None:
+    if metrics_file is None:
+        return
+    with open(metrics_file, "w") as f:
+        f.write(metrics.render())
+
+
+class _Progress:
+    def __init__(
+        self,
+        filenames: List[str],
+        metrics: _Metrics,
+        enabled: bool = True,
+        interval: float = 0.1,
+    ) -> None:
+        self.enabled = enabled
+        self.metrics = metrics
+        self.interval = interval
+        self.total = len(filenames)
+        self.drawn = float("-inf")
+        self.visible = False
+
+    def update(self) -> None:
+        now = time.perf_counter()
+        if self.enabled and now - self.drawn >= self.interval:
+            self.drawn = now
+            self.visible = True
+            self.draw()
+
+    def finish(self) -> None:
+        if self.enabled:
+            self.draw()
+            click.echo(err=True)
+            self.visible = False
+
+    def clear(self) -> None:
+        if self.visible:
+            click.echo("\r\x1b[K", err=True, nl=False)
+            self.visible = False
+
+    def draw(self) -> None:
+        done = self.metrics.files
+        elapsed = max(self.metrics.elapsed, 1e-9)
+        rate = done / elapsed
+        throughput = self.metrics.size / elapsed / 1024 / 1024
+        eta = (self.total - done) / rate if rate else 0.0
+        click.echo(
+            f"\r\x1b[K{done}/{self.total} files, {rate:.1f} files/s, "
+            f"{throughput:.2f} MB/s, ETA {eta:.0f}s",
+            err=True,
+            nl=False,
+        )
+
+
+def _upgrade(
+    source: str,
+    cache: Optional[ParseCache] = None,
+    rewrite: Optional["Rewrite"] = None,
+) -> str:
+    output, _edits = _upgrade_edits(source, cache, rewrite)
+    return output
+
+
+Upgraded = Tuple[str, List[_Edit]]
+
+
+def _upgrade_edits(
+    source: str,
+    cache: Optional[ParseCache] = None,
+    rewrite: Optional["Rewrite"] = None,
+) -> Upgraded:
+    if len(source) > MAX_FILE_SIZE:
+        raise _Skipped(f"file exceeds {MAX_FILE_SIZE} characters")
+    try:
+        ast_obj, tokens = _parse(source, cache)
+        visitor = _FindAssignment()
+        visitor.visit(ast_obj)
+    except (SyntaxError, TokenError, RecursionError, MemoryError) as error:
+        raise _Skipped(f"can not parse: {type(error).__name__}: {error}")
+    _mutate_found(tokens, visitor, rewrite or _rewrite_return)
+    _character_columns(source, visitor.edits)
+    return tokens_to_src(tokens), visitor.edits
+
+
+def _character_columns(source: str, edits: List[_Edit]) -> None:
+    if source.isascii():
+        return
+    lines = LINE_BREAK.split(source)
+    for edit in edits:
+        offset = edit.column
+        edit.column = len(lines[edit.line - 1].encode()[:offset].decode())
+
+
+LINE_BREAK = re.compile("\r\n|\r|\n")
+
+
+MAX_FILE_SIZE = 10_000_000
+
+
+MAX_NESTING_DEPTH = 100
+
+
+MAX_RETURN_TOKENS = 100_000
+
+
+class _Skipped(Exception):
+    pass
+
+
+def _upgrade_batched(source: str, cache: Optional[ParseCache] = None) -> Upgraded:
+    return _upgrade_edits(source, cache, _rewrite_return_batched)
+
+
+Upgrade = Callable[[str], Upgraded]
+
+
+Engine = Callable[[str, Optional[ParseCache]], Upgraded]
+
+
+ENGINES: Dict[str, Engine] = {
+    "batched": _upgrade_batched,
+    "reference": _upgrade_edits,
+}
+
+
+def _select_engine(options: _EngineOptions) -> Upgrade:
+    if options.differential:
+        return _Differential(options.name)
+    engine = ENGINES[options.name]
+    cache = _create_cache(options)
+    return lambda source: engine(source, cache)
+
+
+def _create_cache(options: _EngineOptions) -> Optional[ParseCache]:
+    if options.keep_parsed:
+        return ParseCache(options.cache_dir)
+    if options.cache_dir is not None:
+        return ParseCache(options.cache_dir, max_memory=0)
+    return None
+
+
+@dataclass
+class _Differential:
+    name: str
+    files: int = 0
+    reference_time: float = 0.0
+    candidate_time: float = 0.0
+    lock: Lock = field(default_factory=Lock)
+
+    def __call__(self, source: str) -> Upgraded:
+        expected, reference_time = _timed(_upgrade_edits, source)
+        output, candidate_time = _timed(ENGINES[self.name], source)
+        if output != expected:
+            raise _EngineMismatch(_mismatch(self.name, expected[0], output[0]))
+        with self.lock:
+            self.files += 1
+            self.reference_time += reference_time
+            self.candidate_time += candidate_time
+        return output
+
+    def report(self) -> str:
+        speedup = self.reference_time / max(self.candidate_time, 1e-9)
+        suffix = "s" if self.files != 1 else ""
+        return (
+            f"{self.files} file{suffix} identical to reference, "
+            f"{self.name} engine speedup {speedup:.2f}x"
+        )
+
+
+def _timed(engine: Engine, source: str) -> Tuple[Upgraded, float]:
+    started = time.perf_counter()
+    output = engine(source, None)
+    return output, time.perf_counter() - started
+
+
+class _EngineMismatch(Exception):
+    pass
+
+
+def _mismatch(name: str, expected: str, output: str) -> str:
+    diff = difflib.unified_diff(
+        expected.splitlines(keepends=True),
+        output.splitlines(keepends=True),
+        "reference",
+        name,
+    )
+    return f"{name} engine output differs\n{''.join(diff)}"
+
+
+def _parse(source: str, cache: Optional[ParseCache]) -> Parsed:
+    if cache is None:
+        return _ast_parse(source), src_to_tokens(source)
+    return cache.parse(source)
 
 
 def _ast_parse(source: str) -> ast.Module:
@@ -66,6 +938,7 @@ def _ast_parse(source: str) -> ast.Module:
 class _FindAssignment(ast.NodeVisitor):
     ctx_returned: Set[Offset] = field(default_factory=set)
     ctx_kwargs: Set[Offset] = field(default_factory=set)
+    edits: List[_Edit] = field(default_factory=list)
 
     def visit_Return(self, node: ast.Return) -> None:
         if self.is_success(node.value) or self.is_skip(node.value):
@@ -73,8 +946,14 @@ class _FindAssignment(ast.NodeVisitor):
             if call.keywords:
                 self.ctx_returned.add(_ast_to_offset(node))
                 self.ctx_kwargs.add(_ast_to_offset(call.func))
+                self.edits.append(_edit(node, call))
         self.generic_visit(node)
 
+    def skip(self, offset: Offset, reason: str) -> None:
+        for edit in self.edits:
+            if (edit.line, edit.column) == (offset.line, offset.utf8_byte_offset):
+                edit.skipped = reason
+
     def is_success(self, node: Optional[ast.expr]) -> bool:
         return self.is_returned(node, "Success")
 
@@ -90,27 +969,105 @@ class _FindAssignment(ast.NodeVisitor):
         )
 
 
+def _edit(node: ast.Return, call: ast.Call) -> _Edit:
+    return _Edit(
+        line=node.lineno,
+        column=node.col_offset,
+        returned=cast(ast.Name, call.func).id,
+        keywords=[keyword.arg for keyword in call.keywords],
+    )
+
+
 def _ast_to_offset(node: Union[ast.expr, ast.stmt]) -> Offset:
     return Offset(node.lineno, node.col_offset)
 
 
-def _mutate_found(tokens: List[Token], visitor: _FindAssignment) -> None:
+Rewrite = Callable[[List[Token], int, int, int], None]
+
+
+def _mutate_found(
+    tokens: List[Token], visitor: _FindAssignment, rewrite: Rewrite
+) -> None:
     for i, token in reversed_enumerate(tokens):
         if token.offset in visitor.ctx_kwargs:
             brace_start = i + 1
-            brace_end = _find_closing_brace(tokens, brace_start, "(")
             visitor.ctx_kwargs.remove(token.offset)
         elif token.offset in visitor.ctx_returned:
-            return_start = i
-            if not return_start < brace_start < brace_end:  # pragma: no cover
-                raise Exception
-            inserted = _process_ctx_returned(
-                tokens, return_start, brace_start, brace_end
-            )
-            _process_ctx_kwargs(tokens, brace_start + inserted, brace_end + inserted)
+            try:
+                _rewrite_limited(tokens, i, brace_start, rewrite)
+            except _Skipped as error:
+                visitor.skip(token.offset, str(error))
             visitor.ctx_returned.remove(token.offset)
 
 
+def _rewrite_limited(
+    tokens: List[Token], return_start: int, brace_start: int, rewrite: Rewrite
+) -> None:
+    brace_end = _find_closing_brace(tokens, brace_start, "(")
+    if not return_start < brace_start < brace_end:  # pragma: no cover
+        raise Exception
+    if brace_end - brace_start > MAX_RETURN_TOKENS:
+        raise _Skipped(f"return exceeds {MAX_RETURN_TOKENS} tokens")
+    rewrite(tokens, return_start, brace_start, brace_end)
+
+
+def _rewrite_return(
+    tokens: List[Token], return_start: int, brace_start: int, brace_end: int
+) -> None:
+    inserted = _process_ctx_returned(tokens, return_start, brace_start, brace_end)
+    _process_ctx_kwargs(tokens, brace_start + inserted, brace_end + inserted)
+
+
+def _rewrite_return_batched(
+    tokens: List[Token], return_start: int, brace_start: int, brace_end: int
+) -> None:
+    offset = brace_start + 1
+    limit = brace_end - 1
+    indent = tokens[return_start].utf8_byte_offset
+    line_end = [
+        Token(name="NEWLINE", src=_line_break(tokens, return_start)),
+        Token(name="INDENT", src=" " * indent),
+    ]
+    patch: List[Token] = []
+    for assignment in _split_assign_batched(tokens[offset:limit]):
+        patch.extend(_assignment_patch(assignment, line_end))
+    patch.extend(tokens[return_start:offset])
+    tokens[return_start:limit] = patch
+
+
+CTX_ATTRIBUTE = [Token(name="NAME", src="ctx"), Token(name="OP", src=".")]
+
+
+ASSIGN = [
+    Token(name="UNIMPORTANT_WS", src=" "),
+    Token(name="OP", src="="),
+    Token(name="UNIMPORTANT_WS", src=" "),
+]
+
+
+def _assignment_patch(assignment: List[Token], line_end: List[Token]) -> List[Token]:
+    key = next(
+        (i for i, token in enumerate(assignment) if token.src == "="), len(assignment)
+    )
+    value = key + 1
+    return [
+        *CTX_ATTRIBUTE,
+        *_strip_whitespace(assignment[:key]),
+        *ASSIGN,
+        *_strip_whitespace(assignment[value:]),
+        *line_end,
+    ]
+
+
+def _strip_whitespace(tokens: List[Token]) -> List[Token]:
+    start, end = 0, len(tokens)
+    while start < end and tokens[start].src.isspace():
+        start += 1
+    while end > start and tokens[end - 1].src.isspace():
+        end -= 1
+    return tokens[start:end]
+
+
 def _process_ctx_returned(
     tokens: List[Token], return_start: int, brace_start: int, brace_end: int
 ) -> int:
@@ -119,6 +1076,7 @@ def _process_ctx_returned(
     limit = brace_end - 1
     kwargs = tokens[offset:limit]
     indent = tokens[return_start].utf8_byte_offset
+    line_break = _line_break(tokens, return_start)
 
     for assignment in reversed(list(_split_assign(kwargs))):
         key = takewhile(lambda token: token.src != "=", assignment)
@@ -135,7 +1093,7 @@ def _process_ctx_returned(
             Token(name="OP", src="="),
             Token(name="UNIMPORTANT_WS", src=" "),
             *variable,
-            Token(name="NEWLINE", src="\n"),
+            Token(name="NEWLINE", src=line_break),
             Token(name="INDENT", src=" " * indent),
         ]
         tokens[return_start:return_start] = patch
@@ -143,6 +1101,15 @@ def _process_ctx_returned(
     return inserted
 
 
+def _line_break(tokens: List[Token], return_start: int) -> str:
+    previous = (
+        tokens[i].src
+        for i in range(return_start - 1, -1, -1)
+        if tokens[i].name in {"NEWLINE", "NL"} and tokens[i].src
+    )
+    return next(previous, "\n")
+
+
 def _process_ctx_kwargs(tokens: List[Token], brace_start: int, brace_end: int) -> None:
     offset = brace_start + 1
     limit = brace_end - 1
@@ -150,20 +1117,24 @@ def _process_ctx_kwargs(tokens: List[Token], brace_start: int, brace_end: int) -
 
 
 def _find_closing_brace(tokens: List[Token], i: int, opening: str) -> int:
-    if opening not in BRACES:
-        raise Exception  # pragma: no cover
-    j = i + 1
     brace_stack = [opening]
 
-    while brace_stack:
+    for j in range(i + 1, len(tokens)):
         token = tokens[j].src
-        j += 1
         if token == BRACES[brace_stack[-1]]:
             brace_stack.pop()
+            if not brace_stack:
+                return j + 1
         elif token in BRACES:
-            brace_stack.append(token)
+            _open_brace(brace_stack, token)
+
+    raise _Skipped("unbalanced braces")
 
-    return j
+
+def _open_brace(brace_stack: List[str], token: str) -> None:
+    brace_stack.append(token)
+    if len(brace_stack) > MAX_NESTING_DEPTH:
+        raise _Skipped(f"nesting depth exceeds {MAX_NESTING_DEPTH}")
 
 
 BRACES = {"(": ")", "[": "]", "{": "}"}
@@ -267,5 +1238,31 @@ def _process_tokens(
     return None
 
 
+def _split_assign_batched(kwargs: List[Token]) -> Iterable[List[Token]]:
+    chunk: List[Token] = []
+    for group in _top_level_groups(kwargs):
+        if group[0].src == ",":
+            yield chunk
+            chunk = []
+        elif group[0].name != "COMMENT":
+            chunk.extend(group)
+    if not _all_whitespace(chunk):
+        yield chunk
+
+
+def _top_level_groups(kwargs: List[Token]) -> Iterator[List[Token]]:
+    i = 0
+    while i < len(kwargs):
+        end = _group_end(kwargs, i)
+        yield kwargs[i:end]
+        i = end
+
+
+def _group_end(kwargs: List[Token], i: int) -> int:
+    if kwargs[i].src in BRACES:
+        return _find_closing_brace(kwargs, i, kwargs[i].src)
+    return i + 1
+
+
 def _all_whitespace(tokens: List[Token]) -> bool:
     return all(token.src.isspace() for token in tokens)
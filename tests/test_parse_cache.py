@@ -0,0 +1,179 @@
+"""Test shared parse cache."""
+import ast
+import inspect
+import os
+import sys
+
+from parse_cache import _key
+from parse_cache import ParseCache
+from parse_cache import TOKENIZE_RT_VERSION
+
+
+def test_memory_hit(monkeypatch):
+    """Parse the same source once per cache instance."""
+    cache = ParseCache()
+
+    ast_one, tokens_one = cache.parse("x = 1\n")
+    monkeypatch.setattr(ast, "parse", None)
+    ast_two, tokens_two = cache.parse("x = 1\n")
+
+    assert ast.dump(ast_one) == ast.dump(ast_two)
+    assert tokens_one == tokens_two
+
+
+def test_results_are_copied():
+    """Mutation of the returned AST and tokens should not affect the cache."""
+    cache = ParseCache()
+
+    ast_obj, tokens = cache.parse("x = 1\n")
+    del ast_obj.body[:]
+    del tokens[:]
+
+    ast_obj, tokens = cache.parse("x = 1\n")
+    assert ast_obj.body
+    assert tokens
+
+
+def test_memory_eviction():
+    """Least recently used entries should be evicted over the memory limit."""
+    cache = ParseCache()
+    cache.parse("x = 1\n")
+    cache.parse("z = 3\n")
+    size = cache.memory_size
+
+    cache = ParseCache(max_memory=size)
+    cache.parse("x = 1\n")
+    cache.parse("y = 2\n")
+    cache.parse("x = 1\n")
+    cache.parse("z = 3\n")
+
+    assert list(cache.memory) == [_key("x = 1\n"), _key("z = 3\n")]
+    assert cache.memory_size == size
+
+
+def test_memory_size_counts_serialized_entry():
+    """Memory usage should be measured by the stored entry, not the source."""
+    cache = ParseCache()
+
+    cache.parse("x = 1\n")
+
+    assert cache.memory_size == len(cache.memory[_key("x = 1\n")])
+    assert cache.memory_size > 10 * len("x = 1\n")
+
+
+def test_memory_skip_large_entry():
+    """Entries larger than the memory limit should not be kept at all."""
+    cache = ParseCache(max_memory=0)
+
+    cache.parse("x = 1\n")
+
+    assert not cache.memory
+    assert cache.memory_size == 0
+
+
+def test_disk_hit(tmpdir):
+    """Parse results should be available between cache instances."""
+    ast_obj, tokens = ParseCache(tmpdir.strpath).parse("x = 1\n")
+
+    cache = ParseCache(tmpdir.strpath)
+    assert cache._disk_get(_key("x = 1\n")) is not None
+
+    ast_cached, tokens_cached = cache.parse("x = 1\n")
+    assert ast_cached is not ast_obj
+    assert tokens_cached == tokens
+
+
+def test_disk_corrupted_entry(tmpdir):
+    """Broken cache files should be parsed again."""
+    tmpdir.join(_key("x = 1\n")).write("")
+
+    _ast_obj, tokens = ParseCache(tmpdir.strpath).parse("x = 1\n")
+
+    assert tokens
+
+
+def test_disk_eviction(tmpdir):
+    """Oldest entries should be removed over the disk limit."""
+    cache = ParseCache(tmpdir.strpath)
+    cache.parse("x = 1\n")
+    size = tmpdir.join(_key("x = 1\n")).size()
+    os.utime(tmpdir.join(_key("x = 1\n")).strpath, (0, 0))
+
+    cache.max_disk = size + size // 2
+    cache.parse("y = 2\n")
+
+    assert sorted(os.listdir(tmpdir.strpath)) == [_key("y = 2\n")]
+
+
+def test_disk_eviction_keeps_running_total(tmpdir, monkeypatch):
+    """Writes under the disk limit should not scan the cache directory."""
+    cache = ParseCache(tmpdir.strpath)
+    cache.parse("x = 1\n")
+    monkeypatch.setattr(os, "scandir", None)
+
+    cache.parse("y = 2\n")
+    cache.parse("z = 3\n")
+
+    assert cache.disk_size == sum(f.size() for f in tmpdir.listdir())
+
+
+def test_disk_eviction_leaves_headroom(tmpdir):
+    """Eviction should free space for the following writes."""
+    cache = ParseCache(tmpdir.strpath)
+    for i in range(10):
+        cache.parse(f"x = {i}\n")
+        os.utime(tmpdir.join(_key(f"x = {i}\n")).strpath, (i, i))
+
+    cache.max_disk = sum(f.size() for f in tmpdir.listdir())
+    cache.parse("y = 1\n")
+
+    assert cache.disk_size == sum(f.size() for f in tmpdir.listdir())
+    assert cache.disk_size <= cache.max_disk * 0.9
+    assert len(tmpdir.listdir()) == 9
+    assert not tmpdir.join(_key("x = 0\n")).exists()
+    assert not tmpdir.join(_key("x = 1\n")).exists()
+
+
+def test_key_parser_versions():
+    """Cache key should depend on the source, Python, and tokenize-rt versions."""
+    assert _key("x = 1\n") != _key("x = 2\n")
+    assert "-py{}.{}-".format(*sys.version_info[:2]) in _key("x = 1\n")
+    assert f"-tokenize-rt{TOKENIZE_RT_VERSION}-" in _key("x = 1\n")
+
+
+def test_disk_usage_ignores_other_files(tmpdir):
+    """Temporary files and vanished entries should not count as cache usage."""
+    tmpdir.join("leftover.tmp").write("x" * 1000)
+    tmpdir.join("vanished.parsed").mksymlinkto(tmpdir.join("missing"))
+    cache = ParseCache(tmpdir.strpath)
+
+    cache.parse("x = 1\n")
+
+    assert cache.disk_size == tmpdir.join(_key("x = 1\n")).size()
+
+
+def test_deep_ast_not_cached(tmpdir):
+    """Modules too deep to serialize should be parsed, but not cached."""
+    source = "x = " + "[" * 150 + "]" * 150 + "\n"
+    cache = ParseCache(tmpdir.strpath)
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(len(inspect.stack()) + 100)
+    try:
+        ast_obj, tokens = cache.parse(source)
+    finally:
+        sys.setrecursionlimit(limit)
+
+    assert ast_obj.body
+    assert tokens
+    assert not cache.memory
+    assert not tmpdir.listdir()
+
+
+def test_disk_eviction_of_everything(tmpdir):
+    """All entries should be removed if none of them fits the disk limit."""
+    cache = ParseCache(tmpdir.strpath, max_disk=0)
+
+    cache.parse("x = 1\n")
+
+    assert cache.disk_size == 0
+    assert not tmpdir.listdir()
@@ -1,10 +1,22 @@
 """Test stories library upgrade script."""
+import errno
+import json
+import os
+import subprocess
 from textwrap import dedent
 
 import pytest
 from click.testing import CliRunner
 
+import stories_upgrade
+from stories_upgrade import _create_cache
+from stories_upgrade import _EngineOptions
+from stories_upgrade import _InotifyWatcher
+from stories_upgrade import _Metrics
+from stories_upgrade import _PollingWatcher
+from stories_upgrade import _Progress
 from stories_upgrade import _upgrade
+from stories_upgrade import ENGINES
 from stories_upgrade import main
 
 
@@ -88,6 +100,647 @@ def test_main_changed(tmpdir):
     assert f.read() == after
 
 
+def test_main_line_endings(tmpdir):
+    """Main entrypoint should keep line endings of the updated file."""
+    f = tmpdir.join("f.py")
+    f.write_binary(b"def f():\r\n    return Success(foo=1)\r\n")
+
+    runner = CliRunner()
+
+    result = runner.invoke(main, [f.strpath])
+    assert result.exit_code == 1
+    assert f.read_binary() == (
+        b"def f():\r\n    ctx.foo = 1\r\n    return Success()\r\n"
+    )
+
+
+def test_main_cache_dir(tmpdir):
+    """Main entrypoint should store parsed modules in the cache directory."""
+    f = tmpdir.join("f.py")
+    f.write("x = 1\n")
+    cache_dir = tmpdir.join("cache")
+
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["--cache-dir", cache_dir.strpath, f.strpath])
+    assert result.exit_code == 0
+    assert len(cache_dir.listdir()) == 1
+
+
+def test_create_cache(tmpdir):
+    """Parsed modules should be kept in memory only when they can be reused."""
+    assert _create_cache(_EngineOptions("batched", False, None)) is None
+
+    cache = _create_cache(_EngineOptions("batched", False, tmpdir.strpath))
+    assert cache.directory == tmpdir.strpath
+    assert cache.max_memory == 0
+
+    cache = _create_cache(_EngineOptions("batched", False, None, keep_parsed=True))
+    assert cache.directory is None
+    assert cache.max_memory > 0
+
+
+def test_main_progress(tmpdir):
+    """Main entrypoint should report progress to the stderr."""
+    f = tmpdir.join("f.py")
+    f.write("x = 1\n")
+
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["--progress", f.strpath])
+    assert result.exit_code == 0
+    assert result.stdout == ""
+    assert result.stderr.startswith("\r1/1 files, ")
+    assert " files/s, " in result.stderr
+    assert " MB/s, ETA 0s" in result.stderr
+
+
+def test_main_progress_cleared(tmpdir):
+    """Progress line should be erased before updated files are reported."""
+    f = tmpdir.join("f.py")
+    f.write("def f():\n    return Success(foo=1)\n")
+    g = tmpdir.join("g.py")
+    g.write("def g():\n    return Success(bar=1)\n")
+
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["--progress", f.strpath, g.strpath], color=True)
+    assert result.exit_code == 1
+    assert result.stdout.splitlines() == [
+        f"Update {f.strpath}",
+        f"Update {g.strpath}",
+        "",
+        "2 files updated",
+    ]
+    assert f"ETA 0s\r\x1b[KUpdate {g.strpath}\n" in result.output
+    assert result.output.endswith("ETA 0s\n\n2 files updated\n")
+
+
+def test_progress_throttle(tmpdir):
+    """Progress should not be redrawn more often than the interval."""
+    f = tmpdir.join("f.py")
+    f.write("x = 1\n")
+    metrics = _Metrics()
+    progress = _Progress([f.strpath], metrics, interval=3600)
+    calls = []
+    progress.draw = lambda: calls.append(metrics.files)
+
+    progress.update()
+    progress.update()
+    progress.update()
+
+    assert calls == [0]
+
+
+def test_progress_throttle_after_clear(tmpdir):
+    """Erased progress should be redrawn on the interval or at the finish only."""
+    f = tmpdir.join("f.py")
+    f.write("x = 1\n")
+    metrics = _Metrics()
+    progress = _Progress([f.strpath], metrics, interval=3600)
+    calls = []
+    progress.draw = lambda: calls.append(metrics.files)
+
+    for _ in range(3):
+        progress.update()
+        progress.clear()
+    progress.finish()
+
+    assert calls == [0, 0]
+    assert not progress.visible
+
+
+def test_main_metrics_file(tmpdir):
+    """Main entrypoint should write metrics in the Prometheus text format."""
+    f = tmpdir.join("f.py")
+    f.write("def f():\n    return Success(foo=1)\n")
+    g = tmpdir.join("g.py")
+    g.write("x = 1\n")
+    metrics_file = tmpdir.join("metrics.prom")
+
+    runner = CliRunner()
+
+    result = runner.invoke(
+        main, ["--metrics-file", metrics_file.strpath, f.strpath, g.strpath]
+    )
+    assert result.exit_code == 1
+
+    metrics = metrics_file.read().splitlines()
+    assert "# TYPE stories_upgrade_files_total counter" in metrics
+    assert "stories_upgrade_files_total 2" in metrics
+    assert "stories_upgrade_modified_total 1" in metrics
+    assert "stories_upgrade_bytes_total 41" in metrics
+    assert "# TYPE stories_upgrade_file_duration_seconds histogram" in metrics
+    assert 'stories_upgrade_file_duration_seconds_bucket{le="+Inf"} 2' in metrics
+    assert "stories_upgrade_file_duration_seconds_count 2" in metrics
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+def test_main_patch_out(tmpdir, newline):
+    """Main entrypoint should write the patch instead of updating files."""
+    before = f"def f():{newline}    return Success(foo=1)"
+    after = f"def f():{newline}    ctx.foo = 1{newline}    return Success()"
+
+    f = tmpdir.mkdir("pkg").join("f.py")
+    f.write(before)
+    g = tmpdir.join("g.py")
+    g.write("x = 1\n")
+    patch = tmpdir.join("changes.patch")
+
+    with tmpdir.as_cwd():
+        subprocess.check_call(["git", "init", "-q"])
+        runner = CliRunner()
+        result = runner.invoke(
+            main, ["--patch-out", "changes.patch", f.strpath, "g.py"]
+        )
+        assert result.exit_code == 1
+        assert result.output == f"Update {f.strpath}\n\n1 file updated\n"
+        assert f.read_binary() == before.encode()
+        assert patch.read().startswith("diff --git a/pkg/f.py b/pkg/f.py\n")
+
+        subprocess.check_call(["git", "apply", "changes.patch"])
+        assert f.read_binary() == after.encode()
+
+
+def test_main_patch_out_repository_root(tmpdir):
+    """Patch paths should be relative to the repository root."""
+    f = tmpdir.mkdir("pkg").join("f.py")
+    f.write("def f():\n    return Success(foo=1)\n")
+    patch = tmpdir.join("changes.patch")
+
+    with tmpdir.as_cwd():
+        subprocess.check_call(["git", "init", "-q"])
+    with tmpdir.mkdir("docs").as_cwd():
+        runner = CliRunner()
+        result = runner.invoke(main, ["--patch-out", patch.strpath, "../pkg/f.py"])
+        assert result.exit_code == 1
+        assert patch.read().startswith("diff --git a/pkg/f.py b/pkg/f.py\n")
+
+
+def test_main_patch_out_outside(tmpdir, monkeypatch):
+    """Files outside of the current directory should be reported as an error."""
+    monkeypatch.setenv("GIT_CEILING_DIRECTORIES", tmpdir.strpath)
+    f = tmpdir.join("f.py")
+    f.write("def f():\n    return Success(foo=1)\n")
+
+    with tmpdir.mkdir("docs").as_cwd():
+        runner = CliRunner()
+        result = runner.invoke(main, ["--patch-out", "changes.patch", "../f.py"])
+        assert result.exit_code == 1
+        assert f"Error: ../f.py is outside of {tmpdir.join('docs')}\n" in result.output
+        assert f.read() == "def f():\n    return Success(foo=1)\n"
+
+
+@pytest.fixture
+def git_repo(tmpdir, monkeypatch):
+    """Git repository with committed story definitions."""
+    for var in ["AUTHOR", "COMMITTER"]:
+        monkeypatch.setenv(f"GIT_{var}_NAME", "Test")
+        monkeypatch.setenv(f"GIT_{var}_EMAIL", "test@example.com")
+    tmpdir.mkdir("pkg").join("f.py").write("def f():\n    return Success(foo=1)\n")
+    tmpdir.join("g.py").write("x = 1\n")
+    tmpdir.join("h.txt").write("return Success(foo=1)\n")
+    with tmpdir.as_cwd():
+        subprocess.check_call(["git", "init", "-q"])
+        subprocess.check_call(["git", "add", "."])
+        subprocess.check_call(["git", "commit", "-q", "-m", "Initial"])
+        yield tmpdir
+
+
+def git_output(*args):
+    """Run git command and return its stripped output."""
+    return subprocess.check_output(["git", *args]).decode().strip()
+
+
+def test_main_git_tree(git_repo):
+    """Main entrypoint should commit upgraded blobs without touching files."""
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["--git-tree", "HEAD", "--git-message", "Upgrade"])
+    assert result.exit_code == 1
+
+    commit = git_output("rev-parse", "HEAD")
+    lines = result.output.splitlines()
+    assert lines[0] == "Update pkg/f.py"
+    assert lines[1].startswith("Commit ")
+    assert lines[2:] == ["", "1 file updated"]
+
+    new_commit = lines[1].split()[1]
+    assert git_output("rev-parse", f"{new_commit}^") == commit
+    assert git_output("log", "-1", "--format=%s", new_commit) == "Upgrade"
+    assert git_output("show", f"{new_commit}:pkg/f.py") == (
+        "def f():\n    ctx.foo = 1\n    return Success()"
+    )
+    assert git_output("diff", "--name-only", commit, new_commit) == "pkg/f.py"
+    assert git_repo.join("pkg", "f.py").read() == (
+        "def f():\n    return Success(foo=1)\n"
+    )
+
+
+def test_main_git_tree_without_parent(git_repo):
+    """Commit created from the tree object should not have parents."""
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["--git-tree", "HEAD^{tree}"])
+    assert result.exit_code == 1
+
+    new_commit = result.output.splitlines()[1].split()[1]
+    assert git_output("log", "--format=%P", new_commit) == ""
+
+
+def test_main_git_tree_unchanged(git_repo):
+    """Commit should not be created if nothing changed."""
+    subprocess.check_call(["git", "rm", "-q", "pkg/f.py"])
+    subprocess.check_call(["git", "commit", "-q", "-m", "Remove"])
+
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["--git-tree", "HEAD"])
+    assert result.exit_code == 0
+    assert result.output == ""
+
+
+def test_main_git_tree_errors(git_repo):
+    """Main entrypoint should report wrong usage of the git mode."""
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["--git-tree", "HEAD", "g.py"])
+    assert result.exit_code == 2
+    assert "FILENAMES can not be used together with --git-tree" in result.output
+
+    result = runner.invoke(main, ["--git-tree", "unknown"])
+    assert result.exit_code == 1
+    assert "git ls-tree failed" in result.output
+
+
+@pytest.mark.parametrize(
+    ("option", "name"),
+    [
+        (["--patch-out", "changes.patch"], "--patch-out"),
+        (["--progress"], "--progress"),
+        (["--executor", "thread"], "--executor"),
+    ],
+)
+def test_main_git_tree_unsupported_options(git_repo, option, name):
+    """Options working with files only should be rejected in the git mode."""
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["--git-tree", "HEAD", *option])
+    assert result.exit_code == 2
+    assert f"{name} can not be used together with --git-tree" in result.output
+    assert not git_repo.join("changes.patch").exists()
+
+
+def test_main_git_tree_encoding(git_repo):
+    """Blobs which are not UTF-8 should be skipped, paths may be any bytes."""
+    story = b"def f():\n    return Success(foo=1)\n"
+    path = os.fsdecode(b"caf\xe9.py")
+    git_repo.join(path).write_binary(story)
+    git_repo.join("latin.py").write_binary(b"# caf\xe9\n" + story)
+    subprocess.check_call(["git", "add", "."])
+    subprocess.check_call(["git", "commit", "-q", "-m", "Encoding"])
+
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["--git-tree", "HEAD"])
+    assert result.exit_code == 1
+    assert result.stderr.startswith("Skip latin.py: can not decode: ")
+    new_commit = result.stdout.splitlines()[-3].split()[1]
+    changed = subprocess.check_output(
+        ["git", "diff", "-z", "--name-only", "HEAD", new_commit]
+    )
+    assert changed.split(b"\0")[:-1] == [b"caf\xe9.py", b"pkg/f.py"]
+
+
+@pytest.mark.parametrize("executor", ["serial", "thread", "process"])
+def test_main_executor(tmpdir, executor):
+    """Main entrypoint should report files in order with any executor."""
+    before = "def f():\n    return Success(foo=1)\n"
+    after = "def f():\n    ctx.foo = 1\n    return Success()\n"
+    files = [tmpdir.join(f"f{i}.py") for i in range(5)]
+    for f in files:
+        f.write(before)
+    files[2].write("x = 1\n")
+
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["--executor", executor, *(f.strpath for f in files)])
+    assert result.exit_code == 1
+    updated = [f for i, f in enumerate(files) if i != 2]
+    assert result.output == "".join(f"Update {f.strpath}\n" for f in updated) + (
+        "\n4 files updated\n"
+    )
+    assert [f.read() for f in files] == [after, after, "x = 1\n", after, after]
+
+
+def test_main_process_executor_differential(tmpdir):
+    """Differential mode is not available in the process pool."""
+    f = tmpdir.join("f.py")
+    f.write("x = 1\n")
+
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["--executor", "process", "--differential", f.strpath])
+    assert result.exit_code == 2
+    assert "--differential can not be used with process executor" in result.output
+
+
+@pytest.mark.parametrize("watcher_class", [_InotifyWatcher, _PollingWatcher])
+def test_watcher(tmpdir, watcher_class):
+    """Watchers should report changed Python files in nested directories."""
+    sub = tmpdir.mkdir("sub")
+    sub.join("f.py").write("x = 1\n")
+    tmpdir.mkdir(".git").join("g.py").write("x = 1\n")
+
+    watcher = watcher_class(tmpdir.strpath, 0.05)
+    try:
+        sub.join("f.py").write("x = 2\n")
+        sub.join("f.txt").write("x = 2\n")
+        tmpdir.join(".git", "g.py").write("x = 2\n")
+        tmpdir.join("h.py").write("x = 2\n")
+        assert next(iter(watcher)) == {
+            sub.join("f.py").strpath,
+            tmpdir.join("h.py").strpath,
+        }
+    finally:
+        watcher.close()
+
+
+def test_inotify_watcher_new_directory(tmpdir):
+    """Directories created after the start should be watched as well."""
+    watcher = _InotifyWatcher(tmpdir.strpath, 0.05)
+    try:
+        batches = iter(watcher)
+        sub = tmpdir.mkdir("sub")
+        hidden = tmpdir.mkdir(".hidden")
+        assert next(batches) == set()
+
+        hidden.join("g.py").write("x = 1\n")
+        sub.join("f.py").write("x = 1\n")
+        assert next(batches) == {sub.join("f.py").strpath}
+    finally:
+        watcher.close()
+
+
+def test_inotify_watcher_unclosed_file(tmpdir):
+    """New files should not be reported until the writer closes them."""
+    watcher = _InotifyWatcher(tmpdir.strpath, 0.05)
+    try:
+        batches = iter(watcher)
+        with tmpdir.join("f.py").open("w") as f:
+            f.write("x = 1\n")
+            f.flush()
+            tmpdir.join("g.py").write("x = 1\n")
+            assert next(batches) == {tmpdir.join("g.py").strpath}
+        assert next(batches) == {tmpdir.join("f.py").strpath}
+    finally:
+        watcher.close()
+
+
+class FakeLibc:
+    """C library with inotify calls failing on request."""
+
+    def __init__(self, fd, wd):
+        self.fd = fd
+        self.wd = wd
+
+    def inotify_init1(self, flags):
+        """Return the prepared descriptor."""
+        return self.fd
+
+    def inotify_add_watch(self, fd, path, mask):
+        """Return the prepared watch descriptor."""
+        return self.wd
+
+
+@pytest.fixture
+def fake_libc(monkeypatch):
+    """Replace the C library used by the inotify watcher."""
+
+    def install(fd, wd):
+        libc = FakeLibc(fd, wd)
+        monkeypatch.setattr(stories_upgrade.ctypes, "CDLL", lambda *args, **kw: libc)
+        monkeypatch.setattr(stories_upgrade.ctypes, "get_errno", lambda: errno.ENOSPC)
+        return libc
+
+    return install
+
+
+@pytest.mark.parametrize(
+    ("platform", "fd", "wd"),
+    [("darwin", 0, 0), ("linux", -1, 0), ("linux", None, -1)],
+    ids=["platform", "init", "add-watch"],
+)
+def test_create_watcher_fallback(tmpdir, monkeypatch, fake_libc, platform, fd, wd):
+    """Polling should be used when inotify is not available."""
+    monkeypatch.setattr(stories_upgrade.sys, "platform", platform)
+    if fd is None:
+        fd = os.open(os.devnull, os.O_RDONLY)
+    fake_libc(fd, wd)
+
+    watcher = stories_upgrade._create_watcher(tmpdir.strpath)
+
+    assert isinstance(watcher, _PollingWatcher)
+    if wd < 0:
+        with pytest.raises(OSError, match="Bad file descriptor"):
+            os.close(fd)
+
+
+def test_inotify_watcher_new_directory_error(tmpdir, monkeypatch, capsys):
+    """Directories which can not be watched should be reported."""
+    watcher = _InotifyWatcher(tmpdir.strpath, 0.05)
+    try:
+        wd = next(iter(watcher.directories))
+        sub = tmpdir.mkdir("sub")
+        watcher.libc = FakeLibc(watcher.fd, -1)
+
+        errors = iter([errno.ENOSPC, errno.ENOENT])
+        monkeypatch.setattr(stories_upgrade.ctypes, "get_errno", lambda: next(errors))
+
+        assert watcher.event(wd, stories_upgrade.IN_ISDIR, "sub") is None
+        assert watcher.event(wd, stories_upgrade.IN_ISDIR, "sub") is None
+    finally:
+        watcher.close()
+
+    assert capsys.readouterr().err == (
+        f"Can not watch {sub.strpath}: {os.strerror(errno.ENOSPC)}\n"
+    )
+
+
+def watch_batches(monkeypatch, *batches):
+    """Make the watcher report given batches of changed files."""
+
+    class Watcher:
+        def __iter__(self):
+            yield from batches
+            raise KeyboardInterrupt
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(stories_upgrade, "_create_watcher", lambda directory: Watcher())
+
+
+def test_main_watch(tmpdir, monkeypatch):
+    """Main entrypoint should upgrade files reported by the watcher."""
+    f = tmpdir.join("f.py")
+    f.write("def f():\n    return Success(foo=1)\n")
+    g = tmpdir.join("g.py")
+    h = tmpdir.join("h.py")
+    h.write("x = 1\n")
+    watch_batches(monkeypatch, {f.strpath, g.strpath, h.strpath}, {f.strpath})
+
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["--watch", tmpdir.strpath])
+    assert result.exit_code == 1
+    assert result.stdout == f"Update {f.strpath}\n\n1 file updated\n"
+    assert result.stderr == f"Watching {tmpdir.strpath}\n"
+    assert f.read() == "def f():\n    ctx.foo = 1\n    return Success()\n"
+
+
+def test_main_watch_filenames(tmpdir):
+    """Main entrypoint should not accept files in the watch mode."""
+    f = tmpdir.join("f.py")
+    f.write("x = 1\n")
+
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["--watch", tmpdir.strpath, f.strpath])
+    assert result.exit_code == 2
+    assert "FILENAMES can not be used together with --watch" in result.output
+
+
+@pytest.mark.parametrize(
+    ("option", "name"),
+    [
+        (["--patch-out", "changes.patch"], "--patch-out"),
+        (["--progress"], "--progress"),
+        (["--executor", "process"], "--executor"),
+    ],
+)
+def test_main_watch_unsupported_options(tmpdir, option, name):
+    """Options working with the list of files should be rejected in watch mode."""
+    runner = CliRunner()
+
+    with tmpdir.as_cwd():
+        result = runner.invoke(main, ["--watch", tmpdir.strpath, *option])
+    assert result.exit_code == 2
+    assert f"{name} can not be used together with --watch" in result.output
+    assert not tmpdir.join("changes.patch").exists()
+
+
+def test_main_watch_own_changes(tmpdir, monkeypatch):
+    """Files written by the watch session should not be upgraded again."""
+    f = tmpdir.join("f.py")
+    f.write("def f():\n    return Success(foo=1)\n")
+    watch_batches(monkeypatch, {f.strpath}, {f.strpath})
+    calls = []
+    engine = stories_upgrade.ENGINES["batched"]
+
+    def counted(source, cache):
+        calls.append(source)
+        return engine(source, cache)
+
+    monkeypatch.setitem(stories_upgrade.ENGINES, "batched", counted)
+
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["--watch", tmpdir.strpath])
+    assert result.exit_code == 1
+    assert result.stdout == f"Update {f.strpath}\n\n1 file updated\n"
+    assert calls == ["def f():\n    return Success(foo=1)\n"]
+
+
+def test_main_watch_vanished_file(tmpdir, monkeypatch):
+    """Files removed between the event and the read should be reported."""
+    f = tmpdir.join("f.py")
+    f.write("def f():\n    return Success(foo=1)\n")
+    g = tmpdir.join("g.py")
+    watch_batches(monkeypatch, {f.strpath, g.strpath})
+    monkeypatch.setattr(os.path, "isfile", lambda path: True)
+
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["--watch", tmpdir.strpath])
+    assert result.exit_code == 1
+    assert result.stdout == f"Update {f.strpath}\n\n1 file updated\n"
+    assert result.stderr.splitlines()[1].startswith(
+        f"Skip {g.strpath}: can not update: [Errno 2] No such file or directory"
+    )
+
+
+def test_main_jsonl(tmpdir):
+    """Main entrypoint should stream one JSON record per rewritten return."""
+    f = tmpdir.join("f.py")
+    f.write(
+        dedent(
+            """
+            def one(self, ctx):
+                return Success(foo=1, bar=2)
+
+            def two(self, ctx):
+                if ctx.foo:
+                    return Skip(baz=3)
+                return Success()
+            """
+        )
+    )
+    g = tmpdir.join("g.py")
+    g.write("x = 1\n")
+
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["--format", "jsonl", f.strpath, g.strpath])
+    assert result.exit_code == 1
+    assert [json.loads(line) for line in result.stdout.splitlines()] == [
+        {
+            "kind": "return",
+            "file": f.strpath,
+            "line": 3,
+            "column": 4,
+            "returned": "Success",
+            "keywords": ["foo", "bar"],
+            "skipped": None,
+        },
+        {
+            "kind": "return",
+            "file": f.strpath,
+            "line": 7,
+            "column": 8,
+            "returned": "Skip",
+            "keywords": ["baz"],
+            "skipped": None,
+        },
+    ]
+    assert result.stderr == "\n1 file updated\n"
+
+
+def test_main_jsonl_character_column(tmpdir):
+    """Columns should count characters, not bytes of the encoded line."""
+    f = tmpdir.join("f.py")
+    f.write_text("def f():\n    é = 1; return Success(foo=é)\n", encoding="utf-8")
+
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["--format", "jsonl", f.strpath])
+    assert result.exit_code == 1
+    assert json.loads(result.stdout)["column"] == 11
+
+
+@pytest.mark.parametrize("engine", sorted(ENGINES))
+def test_migrate_whitespace_before_comma(engine):
+    """Whitespace around keyword argument values should not be moved to ctx."""
+    source = "def f():\n    return Success(foo=1 , bar= 2 ,baz =3  )\n"
+
+    output, _edits = ENGINES[engine](source, None)
+
+    assert output == (
+        "def f():\n    ctx.foo = 1\n    ctx.bar = 2\n    ctx.baz = 3\n"
+        "    return Success()\n"
+    )
+
+
 @pytest.mark.parametrize("returned_class", ["Success", "Skip", "Failure", "Result"])
 def test_migrate_empty_ctx(returned_class):
     """Don't modify methods without variable assignment in any case."""
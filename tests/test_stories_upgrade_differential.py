@@ -0,0 +1,138 @@
+"""Compare stories upgrade engines with the reference implementation."""
+import random
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+
+from stories_upgrade import _upgrade
+from stories_upgrade import ENGINES
+from stories_upgrade import main
+
+
+ROOT = Path(__file__).parent.parent
+
+
+CANDIDATES = sorted(name for name in ENGINES if name != "reference")
+
+
+ATOMS = ["1", "'test'", "input()", "ctx.ham", "quiz is not None", "quiz | ctx.ham"]
+
+
+def generate_value(rng, depth):
+    """Generate expression with nested braces, comments, and line breaks."""
+    if depth == 0 or rng.random() < 0.3:
+        return rng.choice(ATOMS)
+    items = [generate_value(rng, depth - 1) for _ in range(rng.randint(0, 3))]
+    kind = rng.choice(["list", "tuple", "dict", "call", "multiline", "comment"])
+    if kind == "list":
+        return "[" + ", ".join(items) + "]"
+    elif kind == "tuple":
+        return "(" + "".join(f"{item}, " for item in items) + ")"
+    elif kind == "dict":
+        return "{" + ", ".join(f"'k{i}': {v}" for i, v in enumerate(items)) + "}"
+    elif kind == "call":
+        return "func(" + ", ".join(f"arg{i}={v}" for i, v in enumerate(items)) + ")"
+    elif kind == "multiline":
+        return "[\n" + "".join(f"            {item},\n" for item in items) + "        ]"
+    else:
+        return (
+            "{\n            # ...\n"
+            + "".join(
+                f"            {i}: {item},  # {i}\n" for i, item in enumerate(items)
+            )
+            + "        }"
+        )
+
+
+def generate_return(rng):
+    """Generate return statement of the story step."""
+    returned_class = rng.choice(["Success", "Skip", "Failure", "Result"])
+    kwargs = [f"key{i}={generate_value(rng, 3)}" for i in range(rng.randint(0, 4))]
+    if rng.random() < 0.5:
+        separator = rng.choice([", ", " , ", ",  "])
+        return f"        return {returned_class}({separator.join(kwargs)})\n"
+    lines = "".join(
+        f"            {kwarg},\n"
+        + ("            # ...\n" if rng.random() < 0.3 else "")
+        for kwarg in kwargs
+    )
+    return f"        return {returned_class}(\n{lines}        )\n"
+
+
+def generate_source(seed):
+    """Generate module with story definition and several steps."""
+    rng = random.Random(seed)
+    steps = []
+    for i in range(rng.randint(1, 5)):
+        prefix = (
+            "        if ctx.flag:\n            pass\n" if rng.random() < 0.3 else ""
+        )
+        steps.append(f"    def step{i}(self, ctx):\n{prefix}{generate_return(rng)}\n")
+    return (
+        "from stories import story, Success, Skip, Failure, Result\n\n\n"
+        "class Action:\n"
+        "    @story\n"
+        "    def do(I):\n"
+        "        I.step0\n\n" + "".join(steps)
+    )
+
+
+@pytest.mark.parametrize("engine", CANDIDATES)
+@pytest.mark.parametrize("seed", range(200))
+def test_generated_corpus(engine, seed):
+    """Engines should produce the same output as reference on generated code."""
+    source = generate_source(seed)
+
+    expected = _upgrade(source)
+
+    output, _edits = ENGINES[engine](source, None)
+    assert output == expected
+    compile(expected, "<generated>", "exec")
+
+
+@pytest.mark.parametrize("engine", CANDIDATES)
+@pytest.mark.parametrize(
+    "filename",
+    sorted(
+        str(path.relative_to(ROOT))
+        for pattern in ["src/*.py", "tests/*.py"]
+        for path in ROOT.glob(pattern)
+    ),
+)
+def test_real_corpus(engine, filename):
+    """Engines should produce the same output as reference on the project code."""
+    source = (ROOT / filename).read_text()
+
+    output, _edits = ENGINES[engine](source, None)
+    assert output == _upgrade(source)
+
+
+def test_main_differential(tmpdir):
+    """Main entrypoint should report the engine speedup."""
+    f = tmpdir.join("f.py")
+    f.write(generate_source(0))
+    g = tmpdir.join("g.py")
+    g.write("x = 1\n")
+
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["--differential", f.strpath, g.strpath])
+    assert "2 files identical to reference, batched engine speedup " in result.output
+
+
+def test_main_differential_mismatch(tmpdir, monkeypatch):
+    """Main entrypoint should fail if the engine output differs."""
+    f = tmpdir.join("f.py")
+    f.write("x = 1\n")
+    monkeypatch.setitem(
+        ENGINES, "batched", lambda source, cache: (source + "y = 2\n", [])
+    )
+
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["--differential", f.strpath])
+    assert result.exit_code == 1
+    assert f"Error: {f.strpath}: batched engine output differs\n" in result.output
+    assert "+y = 2\n" in result.output
+    assert f.read() == "x = 1\n"
@@ -0,0 +1,201 @@
+"""Run stories upgrade engines on adversarial generated files."""
+import gc
+import json
+import time
+import tracemalloc
+
+import pytest
+from click.testing import CliRunner
+from tokenize_rt import src_to_tokens
+
+import stories_upgrade
+from stories_upgrade import _find_closing_brace
+from stories_upgrade import _Skipped
+from stories_upgrade import _upgrade_edits
+from stories_upgrade import ENGINES
+from stories_upgrade import main
+
+
+def nested(depth):
+    """Return step with the list literal nested to the given depth."""
+    return f"def f():\n    return Success(x={'[' * depth}{']' * depth})\n"
+
+
+def wide(width):
+    """Return step with the given number of keyword arguments."""
+    kwargs = ", ".join(f"k{i}=[{i}]" for i in range(width))
+    return f"def f():\n    return Success({kwargs})\n"
+
+
+def many_returns(count):
+    """Return module with the given number of story steps."""
+    return "".join(
+        f"def f{i}():\n    return Success(x={i}, y=[{i}])\n" for i in range(count)
+    )
+
+
+def long_line(length):
+    """Return step with the string literal of the given length."""
+    return f"def f():\n    return Success(x='{'a' * length}')\n"
+
+
+def long_expression(length):
+    """Return step with the binary expression too deep for the parser."""
+    return f"def f():\n    return Success(x={' + '.join(['1'] * length)})\n"
+
+
+def test_unbalanced_braces():
+    """Closing brace search should not run out of the token stream."""
+    tokens = src_to_tokens("f(x, [1, 2])\n")[:-4]
+
+    with pytest.raises(_Skipped, match="^unbalanced braces$"):
+        _find_closing_brace(tokens, 1, "(")
+
+
+@pytest.mark.parametrize("engine", sorted(ENGINES))
+def test_nesting_depth_limit(engine):
+    """Returns with too deeply nested literals should be left as is."""
+    source = nested(150) + wide(1)
+
+    output, edits = ENGINES[engine](source, None)
+
+    assert output == nested(150) + "def f():\n    ctx.k0 = [0]\n    return Success()\n"
+    assert [edit.skipped for edit in edits] == ["nesting depth exceeds 100", None]
+
+
+@pytest.mark.parametrize("engine", sorted(ENGINES))
+def test_return_tokens_limit(engine, monkeypatch):
+    """Returns with too many tokens should be left as is."""
+    monkeypatch.setattr(stories_upgrade, "MAX_RETURN_TOKENS", 100)
+    source = wide(50)
+
+    output, edits = ENGINES[engine](source, None)
+
+    assert output == source
+    assert edits[0].skipped == "return exceeds 100 tokens"
+
+
+def test_file_size_limit(monkeypatch):
+    """Files over the size limit should not be parsed."""
+    monkeypatch.setattr(stories_upgrade, "MAX_FILE_SIZE", 100)
+
+    with pytest.raises(_Skipped, match="^file exceeds 100 characters$"):
+        _upgrade_edits(wide(50))
+
+
+@pytest.mark.parametrize(
+    ("source", "error"),
+    [
+        (nested(1000), "SyntaxError"),
+        (long_expression(20000), "RecursionError"),
+        ("def f(:\n", "SyntaxError"),
+    ],
+)
+def test_unparsable_file(source, error):
+    """Files the parser can not handle should be skipped."""
+    with pytest.raises(_Skipped, match=f"^can not parse: {error}: "):
+        _upgrade_edits(source)
+
+
+@pytest.mark.parametrize("engine", sorted(ENGINES))
+def test_wide_return_rewritten(engine):
+    """Realistically wide returns should stay well under the tokens limit."""
+    output, edits = ENGINES[engine](wide(2000), None)
+
+    assert output.startswith("def f():\n    ctx.k0 = [0]\n    ctx.k1 = [1]\n")
+    assert edits[0].skipped is None
+
+
+SIZES = [
+    (nested, 45),
+    (wide, 100),
+    (many_returns, 40),
+    (long_line, 250000),
+]
+
+
+@pytest.mark.parametrize("engine", sorted(ENGINES))
+@pytest.mark.parametrize(("generate", "size"), SIZES)
+def test_linear_time(engine, generate, size):
+    """Run time should grow linearly with the size of the input.
+
+    Doubling the input of the quadratic algorithm makes it four times
+    slower, so the ratio is checked instead of the absolute time.  Runs
+    on both sizes are interleaved and the best of them is compared to
+    cancel out the noise of the machine.
+
+    """
+    small, large = generate(size), generate(size * 2)
+    timings = {small: [], large: []}
+
+    gc.disable()
+    try:
+        for _ in range(9):
+            for source, runs in timings.items():
+                started = time.perf_counter()
+                ENGINES[engine](source, None)
+                runs.append(time.perf_counter() - started)
+    finally:
+        gc.enable()
+
+    assert min(timings[large]) / min(timings[small]) < 3
+
+
+@pytest.mark.parametrize("engine", sorted(ENGINES))
+@pytest.mark.parametrize(("generate", "size"), SIZES)
+def test_linear_memory(engine, generate, size):
+    """Peak memory should grow linearly with the size of the input."""
+    small = peak_memory(ENGINES[engine], generate(size))
+    large = peak_memory(ENGINES[engine], generate(size * 2))
+
+    assert large / small < 2.5
+
+
+def peak_memory(engine, source):
+    """Return the peak memory allocated by the engine run."""
+    tracemalloc.start()
+    try:
+        engine(source, None)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_main_report_skipped(tmpdir):
+    """Main entrypoint should report skipped files and returns."""
+    f = tmpdir.join("f.py")
+    f.write(nested(150) + wide(1))
+    g = tmpdir.join("g.py")
+    g.write("def f(:\n")
+
+    runner = CliRunner()
+
+    result = runner.invoke(main, [f.strpath, g.strpath])
+    assert result.exit_code == 1
+    assert result.stdout == f"Update {f.strpath}\n\n1 file updated\n"
+    assert result.stderr.splitlines() == [
+        f"Skip {f.strpath}:2:4: nesting depth exceeds 100",
+        f"Skip {g.strpath}: can not parse: SyntaxError: invalid syntax (<unknown>, "
+        "line 1)",
+    ]
+
+
+def test_main_report_skipped_jsonl(tmpdir):
+    """Main entrypoint should stream skip reasons as JSON Lines."""
+    f = tmpdir.join("f.py")
+    f.write(nested(150))
+    g = tmpdir.join("g.py")
+    g.write(nested(1000))
+
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["--format", "jsonl", f.strpath, g.strpath])
+    assert result.exit_code == 0
+    records = [json.loads(line) for line in result.stdout.splitlines()]
+    assert records[0]["kind"] == "return"
+    assert records[0]["skipped"] == "nesting depth exceeds 100"
+    assert records[1].keys() == records[0].keys()
+    assert records[1]["kind"] == "file"
+    assert records[1]["file"] == g.strpath
+    assert records[1]["line"] is None
+    assert records[1]["skipped"].startswith("can not parse: SyntaxError: ")